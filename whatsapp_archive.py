@@ -4,13 +4,24 @@
 
 import argparse
 import collections
-import dateutil.parser
+import datetime
+import functools
 import itertools
 import jinja2
 import logging
+import markupsafe
 import mimetypes
+import operator
 import os.path
-import re
+import sys
+
+try:
+    # Drop-in replacement for re; matches a bit faster and releases the
+    # GIL while matching, which helps when processing many files in
+    # parallel. Entirely optional.
+    import regex as re
+except ImportError:
+    import re
 
 from typing import Optional
 from dataclasses import dataclass
@@ -19,9 +30,14 @@ from dataclasses import dataclass
 # change in the future and so this application will need to be updated.
 # The biggest challenge is that every language seems to have its own set of
 # rules for dates, and it's not trivial to match them all correctly.
-TIME_RE = '(?P<time>[\d:]+( [AP]M)?)'
+# Explicit ASCII classes instead of \d: WhatsApp timestamps and media
+# names are ASCII-only, so there's no reason to pay for Unicode digit
+# category lookups on every character.
+TIME_RE = '(?P<time>[0-9:]+( [AP]M)?)'
 SEPARATOR_RE = '( - |: | )'
-NAME_RE = '(?P<name>[^:]+)'
+# The name can't cross the colon that ends it, and excluding the newline
+# keeps the group from scanning past the line even in multi-line matching.
+NAME_RE = '(?P<name>[^:\n]+)'
 DTSEP_RE = ' ?[,à]? ?'
 
 
@@ -31,16 +47,68 @@ class Error(Exception):
 
 Matchers = collections.namedtuple(
     'Matchers',
-    'date time datetime name firstline line')
+    'date time datetime name line')
+
 
+def _FastParseTimestamp(date_str, time_str):
+    """Parses the already regex-matched date and time strings directly.
 
+    The date matcher only lets through three numeric fields with single
+    character separators, so there's no need for dateutil's generic format
+    inference here. Day-first order is assumed, like in the dateutil call,
+    unless the first field is a 4-digit year. Raises ValueError on anything
+    it doesn't understand; the caller falls back to dateutil.
+    """
+    for sep in '/-.':
+        if sep in date_str:
+            first, second, third = date_str.split(sep)
+            break
+    else:
+        raise ValueError('no date separator in %r' % date_str)
+    if len(first) == 4:
+        year, month, day = int(first), int(second), int(third)
+    else:
+        day, month, year = int(first), int(second), int(third)
+    if year < 100:
+        # Same century pivot as dateutil.
+        year += 2000 if year < 69 else 1900
+    if time_str.endswith('M'):
+        # Trailing ' AM' or ' PM'.
+        ampm = time_str[-2:]
+        time_str = time_str[:-3]
+    else:
+        ampm = None
+    fields = time_str.split(':')
+    hour = int(fields[0])
+    minute = int(fields[1]) if len(fields) > 1 else 0
+    second = int(fields[2]) if len(fields) > 2 else 0
+    if ampm == 'PM' and hour != 12:
+        hour += 12
+    elif ampm == 'AM' and hour == 12:
+        hour = 0
+    return datetime.datetime(year, month, day, hour, minute, second)
+
+
+@functools.lru_cache(maxsize=None)
+def _ParseTimestamp(date_str, time_str):
+    # Exports repeat the same date (and often the same minute) across
+    # thousands of lines, hence the unbounded memo cache.
+    try:
+        return _FastParseTimestamp(date_str, time_str)
+    except ValueError:
+        # Imported lazily: dateutil is only needed for timestamp formats
+        # the fast path doesn't recognize, and importing it is a large
+        # chunk of this script's startup time.
+        import dateutil.parser
+        return dateutil.parser.parse('%s %s' % (date_str, time_str),
+                                     dayfirst=True)
+
+
+@functools.lru_cache(maxsize=1)
 def _MakeDatePattern():
-    patterns = []
-    d = '[\d]+'
-    separators = ['-', '\.', '/']
-    for sep in separators:
-        patterns.append(f'{d}{sep}{d}{sep}{d}')
-    return '(?P<date>' + '|'.join(patterns) + ')'
+    # One character class instead of one alternative per separator; the
+    # engine doesn't need to retry the whole date for each separator style.
+    return r'(?P<date>[0-9]+[-./][0-9]+[-./][0-9]+)'
 
 
 def _MakeDateTimePattern():
@@ -48,46 +116,91 @@ def _MakeDateTimePattern():
 
 
 def _MakeLinePattern():
+    # The name and its trailing colon are optional so that one pattern
+    # covers both regular messages and system messages (e.g. the first
+    # line of an export), scanning the datetime prefix only once.
     return (
         _MakeDateTimePattern() +
         SEPARATOR_RE +
-        NAME_RE +
-        ': ' +
+        '(?:' + NAME_RE + ': )?' +
         '(?P<body>.*$)')
 
 
-def _MakeFirstLinePattern():
-    return (_MakeDateTimePattern() + SEPARATOR_RE + '(?P<body>.*$)')
+# Group indices of the line pattern, resolved once so that ParseLine can
+# fetch all four groups with a single by-index call instead of four
+# by-name lookups per line.
+_G_DATE, _G_TIME, _G_NAME, _G_BODY = (
+    re.compile(_MakeLinePattern()).groupindex[g]
+    for g in ('date', 'time', 'name', 'body'))
+
+
+def _DropGroupNames(pattern):
+    """Turns named groups into plain ones, for reuse inside a lookahead."""
+    return re.sub(r'\(\?P<[a-z]+>', '(?:', pattern)
+
 
+def _MakeMessagePattern():
+    # One pattern for a whole message, including its continuation lines: a
+    # continuation is any line that doesn't look like a message header.
+    header = _MakeDateTimePattern() + SEPARATOR_RE
+    not_header = '(?!' + _DropGroupNames(header) + ')'
+    return re.compile(
+        '^' + header + '(?:' + NAME_RE + ': )?' +
+        r'(?P<body>.*(?:\n' + not_header + '.*)*)',
+        re.M)
 
+
+@functools.lru_cache(maxsize=1)
 def _MakeMatchers() -> Matchers:
+    # Every field is a compiled Pattern, so no caller pays re's internal
+    # cache lookup per match, and the whole tuple is memoized so repeated
+    # callers (every IdentifyMessages invocation, the tests) share one set
+    # of patterns. Use .pattern where the source string is needed for
+    # concatenation into bigger patterns.
     return Matchers(
-        date = _MakeDatePattern(),
-        time = TIME_RE,
-        datetime = _MakeDateTimePattern(),
-        name = NAME_RE,
-        firstline = _MakeFirstLinePattern(),
-        line = _MakeLinePattern(),
+        date = re.compile(_MakeDatePattern()),
+        time = re.compile(TIME_RE),
+        datetime = re.compile(_MakeDateTimePattern()),
+        name = re.compile(NAME_RE),
+        line = re.compile(_MakeLinePattern()),
     )
 
 
 def ParseLine(matchers: Matchers, line: str):
     """Parses a single line of WhatsApp export file."""
-    m = re.match(matchers.line, line)
-    if m:
-        d = dateutil.parser.parse("%s %s" % (m.group('date'),
-            m.group('time')), dayfirst=True)
-        return d, m.group('name'), m.group('body')
-    # Maybe it's the first line which doesn't contain a person's name.
-    m = re.match(matchers.firstline, line)
+    # Every message header starts with a digit or '[' (see
+    # _MakeDateTimePattern), so continuation lines of multi-line messages
+    # can be rejected with a one-character check instead of a regex pass.
+    c = line[:1]
+    if c != '[' and not c.isdigit():
+        return None
+    m = matchers.line.match(line)
     if m:
-        d = dateutil.parser.parse("%s %s" % (m.group('date'),
-            m.group('time')), dayfirst=True)
-        return d, 'nobody', m.group('body')
+        date_str, time_str, name, body = m.group(
+            _G_DATE, _G_TIME, _G_NAME, _G_BODY)
+        d = _ParseTimestamp(date_str, time_str)
+        # System messages, e.g. the first line of an export, don't carry a
+        # person's name.
+        if name is None:
+            name = 'nobody'
+        else:
+            # A chat has few distinct authors repeated over thousands of
+            # messages; interning makes them share one string object, so
+            # the grouping key comparisons are pointer-fast.
+            name = sys.intern(name)
+        return d, name, body
     return None
 
 
-FILE_RE = u'(?P<path>(AUD|PTT|STK|IMG|VID|DOC)-(\d){8}-WA\d+\.(m4a|jpg|mp4|pdf|webp|gif|opus|mp3|aac|wav|mpeg|3gp|avi|wmm|jpeg|png|tiff|ico))'
+FILE_RE = u'(?P<path>(AUD|PTT|STK|IMG|VID|DOC)-([0-9]){8}-WA[0-9]+\.(m4a|jpg|mp4|pdf|webp|gif|opus|mp3|aac|wav|mpeg|3gp|avi|wmm|jpeg|png|tiff|ico))'
+
+# Compiled once; these run against every message body.
+_MEDIA_PATH = re.compile(u'\u200e?' + FILE_RE, re.U)
+_MEDIA_FULL = re.compile(u'\u200e?' + FILE_RE + ' \([a-z ]+\)', re.U)
+
+# Cheap prefix test to reject ordinary text messages before invoking the
+# media regex; media filenames always start with one of these.
+_MEDIA_PREFIXES = ('AUD-', 'PTT-', 'STK-', 'IMG-', 'VID-', 'DOC-')
 
 
 @dataclass
@@ -97,7 +210,7 @@ class Media:
 
 
 def MediaMessageToPath(msg_body: str) -> Optional[str]:
-    m = re.match(u'\u200e?' + FILE_RE, msg_body, re.U)
+    m = _MEDIA_PATH.match(msg_body)
     if m:
         return m.group('path')
 
@@ -109,25 +222,37 @@ def AsMedia(msg_body: str) -> Optional[Media]:
     text in the parentheses. We just match that there's something in
     parentheses.
     """
-    m = re.match(u'\u200e?' + FILE_RE + ' \([a-z ]+\)', msg_body, re.U)
+    b = msg_body[1:] if msg_body.startswith(u'\u200e') else msg_body
+    if not b.startswith(_MEDIA_PREFIXES):
+        return None
+    m = _MEDIA_FULL.match(msg_body)
     if m is not None:
-        path = MediaMessageToPath(msg_body)
+        path = m.group('path')
         mime_type, _ = mimetypes.guess_type(path)
         return Media(path, mime_type)
     return None
 
 
+# One parsed message. A namedtuple rather than a dataclass on purpose: it
+# compares and unpacks like the plain tuples it replaced, while giving the
+# template readable attribute access.
+Message = collections.namedtuple('Message', 'date user body media')
+
+
 def IdentifyMessages(lines):
     """Input text can contain multi-line messages. If there's a line that
     doesn't start with a date and a name, that's probably a continuation of the
     previous message and should be appended to it.
+
+    A generator: accepts any iterable of lines and yields Message records
+    as they complete, so only one message is held in memory at a time.
     """
     matchers = _MakeMatchers()
-    messages = []
     msg_date = None
     msg_user = None
-    msg_body = None
-    msg_media = None
+    # Collect body lines in a list and join once when the message is
+    # complete; repeated string += is quadratic on long messages.
+    msg_body_parts = None
     for line in lines:
         m = ParseLine(matchers, line)
         if m is not None:
@@ -135,22 +260,53 @@ def IdentifyMessages(lines):
                 # We have a new message, so there will be no more lines for the
                 # one we've seen previously -- it's complete. Let's add it to
                 # the list.
-                msg_media = AsMedia(msg_body)
-                messages.append((msg_date, msg_user, msg_body, msg_media))
-                msg_date, msg_user, msg_body, msg_media = None, None, None, None
-            msg_date, msg_user, msg_body = m
+                msg_body = '\n'.join(msg_body_parts)
+                yield Message(msg_date, msg_user, msg_body,
+                              AsMedia(msg_body))
+            msg_date, msg_user, first_line = m
+            msg_body_parts = [first_line]
         else:
             if msg_date is None:
                 raise Error("Can't parse the first line: " + repr(line) +
-                        ', regexes are first_line = ' + repr(matchers.firstline) +
-                        ' and line =' + repr(matchers.line))
-            msg_body += '\n' + line.strip()
-            msg_media = AsMedia(line.strip())
+                        ', regex is line = ' + repr(matchers.line))
+            # Only the line terminator (and stray trailing whitespace)
+            # needs to go; leading whitespace is part of the message.
+            msg_body_parts.append(line.rstrip())
     # The last message remains. Let's add it, if it exists.
     if msg_date is not None:
-        msg_media = AsMedia(msg_body)
-        messages.append((msg_date, msg_user, msg_body, msg_media))
-    return messages
+        msg_body = '\n'.join(msg_body_parts)
+        yield Message(msg_date, msg_user, msg_body, AsMedia(msg_body))
+
+
+_MESSAGE_RE = _MakeMessagePattern()
+
+
+def IdentifyMessagesFromText(text):
+    """Like IdentifyMessages, but for the whole export as one string.
+
+    A single multi-line pattern walks the text inside the regex engine
+    instead of crossing the Python/C boundary once per line, which is
+    faster when the caller already holds the full text in memory. Also a
+    generator, like IdentifyMessages.
+    """
+    # Without this, the last message would absorb the file-final newline as
+    # an empty continuation line.
+    if text.endswith('\n'):
+        text = text[:-1]
+    for m in _MESSAGE_RE.finditer(text):
+        msg_date = _ParseTimestamp(m.group('date'), m.group('time'))
+        msg_user = m.group('name')
+        if msg_user is None:
+            msg_user = 'nobody'
+        else:
+            msg_user = sys.intern(msg_user)
+        msg_body = m.group('body')
+        if '\n' in msg_body:
+            # Continuation lines get the same whitespace treatment as in
+            # IdentifyMessages.
+            first, *rest = msg_body.split('\n')
+            msg_body = '\n'.join([first] + [part.rstrip() for part in rest])
+        yield Message(msg_date, msg_user, msg_body, AsMedia(msg_body))
 
 
 def TemplateData(messages, input_filename):
@@ -160,32 +316,42 @@ def TemplateData(messages, input_filename):
     """
     by_user = []
     file_basename = os.path.basename(input_filename)
-    for user, msgs_of_user in itertools.groupby(messages, lambda x: x[1]):
-        msgs_as_list = list(msgs_of_user)
-        by_user.append((user, msgs_as_list[0][0].date(), msgs_as_list))
-    dates = []
-    prev_date = None
-    for _, first_msg_date, _ in by_user:
-        if first_msg_date != prev_date:
-            dates.append(first_msg_date)
-        prev_date = first_msg_date
+    # Chats concentrate many speaker turns on few distinct days, so one
+    # date object is allocated per day and shared by every turn (and by
+    # the dates index below) instead of one .date() call per turn.
+    day_cache = {}
+    for user, msgs_of_user in itertools.groupby(messages,
+                                                operator.itemgetter(1)):
+        # Escape the bodies here, once, rather than per render in the
+        # template; markupsafe's C escape over the list beats the Jinja
+        # filter dispatch, and autoescape passes Markup through untouched.
+        msgs_as_list = [Message(date, name, markupsafe.escape(body), media)
+                        for date, name, body, media in msgs_of_user]
+        first = msgs_as_list[0].date
+        key = (first.year, first.month, first.day)
+        first_msg_date = day_cache.get(key)
+        if first_msg_date is None:
+            first_msg_date = day_cache[key] = first.date()
+        by_user.append((user, first_msg_date, msgs_as_list))
+    # Deduplicate in C while keeping first-seen order.
+    dates = list(dict.fromkeys(
+        first_msg_date for _, first_msg_date, _ in by_user))
     by_month = []
     # Item format:
     # ((year, month), [(day_of_month, datetime_object)])
-    for month, days in itertools.groupby(dates, lambda x: (x.year, x.month)):
+    for month, days in itertools.groupby(dates,
+                                         operator.attrgetter('year', 'month')):
         by_month.append((month, [(d.day, d) for d in days]))
     return dict(by_user=by_user, dates=by_month, input_basename=file_basename,
             input_full_path=input_filename)
 
 
-def FormatHTML(data):
-    tmpl = """<!DOCTYPE html>
-    <html>
-    <head>
-        <title>WhatsApp archive {{ input_basename }}</title>
-        <meta charset="utf-8"/>
-        <meta name="viewport" content="width=device-width, initial-scale=1">
-        <style>
+# Compiled once at import time; parsing and compiling the template is not
+# free and FormatHTML may be called more than once per process.
+# The stylesheet is static -- no template variables -- so it lives in its
+# own constant and is spliced into the template source once, at build
+# time, instead of sitting inside the template as a big literal node.
+_CSS = """
             body {
                 font-family: Arial, Helvetica, sans-serif;
                 font-size: 10px;
@@ -255,7 +421,15 @@ def FormatHTML(data):
             ol.date-index {
                 list-style: none;
             }
-        </style>
+        """
+
+_TEMPLATE_STR = """<!DOCTYPE html>
+    <html>
+    <head>
+        <title>WhatsApp archive {{ input_basename }}</title>
+        <meta charset="utf-8"/>
+        <meta name="viewport" content="width=device-width, initial-scale=1">
+        <style>""" + _CSS + """</style>
 
     </head>
     <body>
@@ -275,27 +449,27 @@ def FormatHTML(data):
             <a id="{{first_msg_date}}">
                 <span class="username">{{ user }}</span>
             </a>
-            <span class="date">{{ messages[0][0] }}</span>
+            <span class="date">{{ messages[0].date }}</span>
             <ol class="messages">
-            {% for _, _, body, media in messages -%}
-            {% if media is not none -%}
+            {% for message in messages -%}
+            {% if message.media is not none -%}
                 <li class="media">
-                {% if media.mime.startswith("image/") %}
-                    <a href='{{ media.path }}' target="_blank"><img src='{{ media.path }}' width="400"></img></a>
-                {% elif media.mime.startswith("audio/") %}
+                {% if message.media.mime.startswith("image/") %}
+                    <a href='{{ message.media.path }}' target="_blank"><img src='{{ message.media.path }}' width="400"></img></a>
+                {% elif message.media.mime.startswith("audio/") %}
                     <audio controls>
-                        <source src="{{ media.path }}" type="{{ media.mime }}">
+                        <source src="{{ message.media.path }}" type="{{ message.media.mime }}">
                     </audio>
-                {% elif media.mime.startswith("video/") %}
+                {% elif message.media.mime.startswith("video/") %}
                     <video controls>
-                        <source src="{{ media.path }}" type="{{ media.mime }}"/>
+                        <source src="{{ message.media.path }}" type="{{ message.media.mime }}"/>
                     </video>
                 {%- else -%}
-                    unsupported media {{ media.path | e }}
+                    unsupported media {{ message.media.path }}
                 {%- endif %}
                 </li>
             {% else %}
-                <li class="text-msg">{{ body | e }}</li>
+                <li class="text-msg">{{ message.body }}</li>
             {% endif %}
             {%- endfor %}
             </ol>
@@ -305,7 +479,21 @@ def FormatHTML(data):
     </body>
     </html>
     """
-    return jinja2.Environment().from_string(tmpl).render(**data)
+
+_ENV = jinja2.Environment(autoescape=True)
+_TEMPLATE = _ENV.from_string(_TEMPLATE_STR)
+
+
+def FormatHTML(data):
+    return _TEMPLATE.render(**data)
+
+
+def WriteHTML(data, fd):
+    """Renders the template and writes it to fd in chunks.
+
+    Unlike FormatHTML, this never holds the whole document in memory.
+    """
+    _TEMPLATE.stream(**data).dump(fd)
 
 
 def main():
@@ -315,12 +503,15 @@ def main():
     parser.add_argument('-i', dest='input_file', required=True)
     parser.add_argument('-o', dest='output_file', required=True)
     args = parser.parse_args()
-    with open(args.input_file, 'rt', encoding='utf-8-sig') as fd:
-        messages = IdentifyMessages(fd.readlines())
-    template_data = TemplateData(messages, args.input_file)
-    HTML = FormatHTML(template_data)
+    # Iterate over the file directly instead of materializing all lines up
+    # front; a large read buffer keeps the I/O chunky.
+    with open(args.input_file, 'rt', encoding='utf-8-sig',
+              buffering=1 << 20) as fd:
+        # IdentifyMessages is a generator, so it has to be drained before
+        # the input file closes.
+        template_data = TemplateData(IdentifyMessages(fd), args.input_file)
     with open(args.output_file, 'w', encoding='utf-8') as fd:
-        fd.write(HTML)
+        WriteHTML(template_data, fd)
 
 
 if __name__ == '__main__':
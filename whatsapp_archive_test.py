@@ -32,12 +32,12 @@ INPUT_7 = ["17/12/2022 à 17:25 - personne1: Vaccin ok 💪\n",]
 class IdentifyMessagesTest(unittest.TestCase):
 
     def testInputMultiline(self):
-        self.assertEqual(whatsapp_archive.IdentifyMessages(INPUT_1), [
+        self.assertEqual(list(whatsapp_archive.IdentifyMessages(INPUT_1)), [
             (datetime.datetime(2018, 1, 13, 1, 23), 'Fake Name', 'line1\nline2', None),
         ])
 
     def testInputTwoMultiline(self):
-        self.assertEqual(whatsapp_archive.IdentifyMessages(INPUT_2), [
+        self.assertEqual(list(whatsapp_archive.IdentifyMessages(INPUT_2)), [
             (datetime.datetime(2018, 1, 13, 1, 23), 'Fake Name', 'line1\nline2', None),
             (datetime.datetime(2018, 1, 13, 1, 24), 'Name Two', 'single line', None),
         ])
@@ -138,14 +138,14 @@ class IdentifyMessagesTest(unittest.TestCase):
     def testEwoutTime(self):
         INPUT = """[02-12-18 22:55:45]"""
         matchers = whatsapp_archive._MakeMatchers()
-        result = re.match(matchers.datetime, INPUT)
+        result = matchers.datetime.match(INPUT)
         self.assertIsNotNone(result)
         self.assertEqual(('02-12-18', '22:55:45', None), result.groups())
 
     def testEwoutName(self):
         INPUT = """[02-12-18 22:55:45] Ewout:"""
         matchers = whatsapp_archive._MakeMatchers()
-        pattern = (matchers.datetime + whatsapp_archive.SEPARATOR_RE
+        pattern = (matchers.datetime.pattern + whatsapp_archive.SEPARATOR_RE
                 + whatsapp_archive.NAME_RE)
         result = re.match(pattern, INPUT)
         self.assertIsNotNone(result)
@@ -156,7 +156,7 @@ class IdentifyMessagesTest(unittest.TestCase):
     def testEwout1(self):
         INPUT = ["""[02-12-18 22:55:45] Ewout: Test\n""",]
         self.maxDiff = None
-        messages = whatsapp_archive.IdentifyMessages(INPUT)
+        messages = list(whatsapp_archive.IdentifyMessages(INPUT))
         self.assertEqual(
                 [(datetime.datetime(2018, 12, 2, 22, 55, 45), 'Ewout', 'Test', None)],
                 messages)
@@ -167,7 +167,7 @@ class IdentifyMessagesTest(unittest.TestCase):
                  "[02-12-18 22:56:20] Ewout: Sending a message to myself\n",
         ]
         self.maxDiff = None
-        messages = whatsapp_archive.IdentifyMessages(INPUT)
+        messages = list(whatsapp_archive.IdentifyMessages(INPUT))
         self.assertEqual([
             (datetime.datetime(2018, 12, 2, 22, 55, 45), 'Ewout', 'Test', None),
             (datetime.datetime(2018, 12, 2, 22, 56), 'Ewout', 'Does this work?', None),
@@ -201,7 +201,7 @@ class IdentifyMessagesTest(unittest.TestCase):
             "17.02.19, 12:28 - +7 982 111-11-11: Пётр, ждём! Развязки\n",
         ]
         self.maxDiff = None
-        messages = whatsapp_archive.IdentifyMessages(INPUT)
+        messages = list(whatsapp_archive.IdentifyMessages(INPUT))
         self.assertEqual([
             (datetime.datetime(2019, 2, 12, 14, 22), 'nobody',
              'Сообщения в данной группе теперь защищены сквозным '